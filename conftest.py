@@ -0,0 +1,40 @@
+import os
+from pathlib import Path
+import shutil
+
+import pytest
+
+
+@pytest.fixture(scope="session", autouse=True)
+def tmpfs_root():
+    # Setting TMPFS_ROOT (e.g. TMPFS_ROOT=/dev/shm/lab-tests) runs the suite out of
+    # a copy of the lab in that directory, which keeps repeated runs off the disk.
+    root = os.environ.get("TMPFS_ROOT")
+    if not root:
+        yield None
+        return
+
+    # Each xdist worker gets its own copy so they don't race while copying
+    root = Path(root) / os.environ.get("PYTEST_XDIST_WORKER", "main")
+    root.mkdir(parents=True, exist_ok=True)
+    for directory in ["bin", "src"]:
+        if Path(directory).is_dir():
+            shutil.copytree(directory, root / directory, dirs_exist_ok=True)
+    shutil.copy2("server.py", root / "server.py")
+
+    cwd = os.getcwd()
+    os.chdir(root)
+
+    yield root
+
+    os.chdir(cwd)
+
+
+@pytest.hookimpl(optionalhook=True)
+def pytest_json_runtest_metadata(item, call):
+    # Report the metadata set with @meta for every outcome, including tests that
+    # are skipped before any fixture runs
+    metadata = getattr(getattr(item, "function", None), "__meta__", None)
+    if metadata:
+        type_, description = metadata
+        return {"type": type_, "description": description}
@@ -1,5 +1,11 @@
 from pathlib import Path
+import os
+import select
+import selectors
+import shlex
+import shutil
 import signal
+import socket
 import subprocess
 import threading
 import time
@@ -9,103 +15,280 @@ import server as tcp_server
 import pytest
 
 
+def free_ports(count):
+    # Let the kernel pick unused ports. The sockets are all held open until
+    # every port has been picked so the same port can't be handed out twice.
+    sockets = [socket.socket() for _ in range(count)]
+    try:
+        for sock in sockets:
+            sock.bind(("", 0))
+
+        return [sock.getsockname()[1] for sock in sockets]
+    finally:
+        for sock in sockets:
+            sock.close()
+
+
+# The server ports are picked by the kernel so they don't collide with another
+# xdist worker or a previous run's sockets in TIME_WAIT. The second port is for
+# test_different_port and the third is for the --same-output server. Port 8080
+# is the client's default and test_no_connection expects nothing on it.
+PORT, OTHER_PORT, SAME_OUTPUT_PORT = free_ports(3)
+while 8080 in (PORT, OTHER_PORT, SAME_OUTPUT_PORT):
+    PORT, OTHER_PORT, SAME_OUTPUT_PORT = free_ports(3)
+
+LARGE_INPUT = "x" * 1024  # Make we don't go above the limit for the lab
+LARGE_INPUT_EXPECTED = LARGE_INPUT.upper()
+
+ACTIONS_TEXT = "this is a test"
+
+CLANG_FORMAT = shutil.which("clang-format")
+requires_clang_format = pytest.mark.skipif(
+    not CLANG_FORMAT, reason="clang-format not installed"
+)
+
+# Code must match either of these clang-format styles
+STYLE_1 = "{BasedOnStyle: LLVM, UseTab: Never, IndentWidth: 4, TabWidth: 4}"
+STYLE_2 = "{ BasedOnStyle: LLVM, UseTab: Never, IndentWidth: 4, TabWidth: 4, ColumnLimit: 100 }"
+C_FILES = tuple(p for p in Path("src").glob("*.c") if p.name != "log.c")
+
+
+def run_capped(args, cap=65536):
+    # Like subprocess.run(args, capture_output=True), but a process that prints
+    # more than cap bytes to either stream is killed and fails the test.
+    process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output = {process.stdout: bytearray(), process.stderr: bytearray()}
+    truncated = False
+
+    with selectors.DefaultSelector() as selector:
+        for stream in output:
+            selector.register(stream, selectors.EVENT_READ)
+
+        while selector.get_map():
+            for key, _ in selector.select():
+                chunk = os.read(key.fd, 4096)
+                if not chunk:
+                    selector.unregister(key.fileobj)
+                    continue
+
+                buffer = output[key.fileobj]
+                buffer += chunk
+                if len(buffer) > cap:
+                    truncated = True
+                    process.kill()
+                    for stream in output:
+                        if stream in selector.get_map():
+                            selector.unregister(stream)
+                    break
+
+    process.stdout.close()
+    process.stderr.close()
+    returncode = process.wait()
+
+    if truncated:
+        pytest.fail(f"{args[0]} wrote more than {cap} bytes and was killed")
+
+    return subprocess.CompletedProcess(
+        args, returncode, bytes(output[process.stdout]), bytes(output[process.stderr])
+    )
+
+
+def assert_usage_error(result):
+    assert result.stdout == b""
+    assert result.stderr != b""
+    assert result.returncode == 1
+
+    message, _, usage = result.stderr.partition(b"\n")
+
+    # First line should be error message
+    assert not message.startswith(b"Usage")
+    # Second line should contain the usage
+    assert b"Usage" in usage
+
+
+def meta(type_, description):
+    # Attach the report metadata to a test. The pytest_json_runtest_metadata
+    # hook in conftest.py adds it to the JSON report.
+    def decorator(function):
+        function.__meta__ = (type_, description)
+        return function
+
+    return decorator
+
+
 @pytest.fixture()
 def client():
-    def run(args=None):
-        args = args or ""
+    exe = str(Path("bin/tcp_client").resolve())
+
+    def run(args=""):
+        # Arguments can be a command line string or an already split list
+        if isinstance(args, str):
+            args = shlex.split(args)
 
-        return subprocess.run(f"bin/tcp_client {args}", capture_output=True, shell=True)
+        return run_capped([exe, *args])
 
     return run
 
 
-@pytest.fixture()
+def wait_for_server(process, port, timeout=0.5):
+    # Poll until the server accepts connections instead of sleeping blindly. On
+    # Linux a pidfd lets the pause between attempts wake up as soon as the server
+    # exits.
+    try:
+        pidfd = os.pidfd_open(process.pid)
+    except (AttributeError, OSError):
+        pidfd = None
+
+    deadline = time.monotonic() + timeout
+
+    try:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                pytest.fail(f"Server exited with return code {process.returncode}")
+
+            with socket.socket() as sock:
+                sock.settimeout(0.01)
+                if sock.connect_ex(("127.0.0.1", port)) == 0:
+                    return
+
+            if pidfd is not None:
+                select.select([pidfd], [], [], 0.005)
+            else:
+                time.sleep(0.005)
+    finally:
+        if pidfd is not None:
+            os.close(pidfd)
+
+    pytest.fail(f"Server did not accept connections on port {port}")
+
+
+def stop_server(process):
+    # Returns False if the server ignored SIGTERM and had to be killed
+    if process.poll() is not None:
+        return True
+
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(timeout=0.2)
+        return True
+    except ProcessLookupError:
+        return True
+    except subprocess.TimeoutExpired:
+        pass
+
+    # The server may have exited on its own since the timeout
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    process.wait()
+    return False
+
+
+@pytest.fixture(scope="session")
 def server():
-    process = None
+    # Servers are shared across the whole session, keyed by their configuration
+    procs: dict[tuple[int, bool], subprocess.Popen] = {}
+    # Servers that ignored SIGTERM. These are reported once at the end so the
+    # rest of the servers still get cleaned up.
+    leaks = []
+
+    def stop(key, process):
+        if not stop_server(process):
+            leaks.append(key)
+
+    def run(port=None, same_output=False):
+        # Each configuration has its own default port so both can stay running
+        if port is None:
+            port = SAME_OUTPUT_PORT if same_output else PORT
 
-    def run(port=8080, same_output=False):
-        nonlocal process
+        key = (port, same_output)
+        process = procs.get(key)
+        if process is not None and process.poll() is None:
+            return process
+
+        # A server that died is dropped and started again
+        procs.pop(key, None)
+
+        # Only one server can be bound to a port at a time
+        for other in [k for k in procs if k[0] == port]:
+            stop(other, procs.pop(other))
 
         args = ["python", "server.py", "--port", f"{port}"]
         if same_output:
             args.append("--same-output")
 
-        process = subprocess.Popen(args)
+        # Start the server in its own session so the whole group can be killed
+        process = subprocess.Popen(args, start_new_session=True)
+        procs[key] = process
         try:
-            process.wait(timeout=0.5)
-        except subprocess.TimeoutExpired:
-            pass
+            wait_for_server(process, port)
+        except pytest.fail.Exception:
+            stop(key, procs.pop(key))
+            raise
 
         return process
 
     yield run
 
-    if process:
-        process.send_signal(signal.SIGINT)
+    for key, process in procs.items():
+        stop(key, process)
 
+    if leaks:
+        pytest.fail(f"Servers did not exit on SIGTERM and were killed: {leaks}")
 
-def test_format(json_metadata):
-    json_metadata["type"] = "coding-standard"
-    json_metadata["description"] = "Check that code is formatted correctly."
 
-    for source_file in Path("src/").glob("*.c"):
-        if source_file.name == "log.c":
-            continue
+@meta("coding-standard", "Check that code is formatted correctly.")
+@requires_clang_format
+def test_format():
+    if not C_FILES:
+        return
 
-        style_1_result = subprocess.run(
-            f'clang-format --style="{{BasedOnStyle: LLVM, UseTab: Never, IndentWidth: 4, TabWidth: 4}}" "{source_file}" | diff - "{source_file}"',
-            shell=True,
+    def formatted(style):
+        # One clang-format call per style covers every file. It prints one XML
+        # document per file, and a file is formatted if it needs no replacements.
+        result = subprocess.run(
+            [CLANG_FORMAT, "--output-replacements-xml", f"--style={style}"]
+            + [str(f) for f in C_FILES],
             capture_output=True,
         )
+        assert result.returncode == 0, result.stderr.decode()
 
-        style_2_result = subprocess.run(
-            f'clang-format --style="{{ BasedOnStyle: LLVM, UseTab: Never, IndentWidth: 4, TabWidth: 4, ColumnLimit: 100 }}" "{source_file}" | diff - "{source_file}"',
-            shell=True,
-            capture_output=True,
-        )
+        sections = result.stdout.decode().split("<?xml")[1:]
+        assert len(sections) == len(C_FILES), result.stderr.decode()
 
-        assert (
-            len(style_1_result.stdout.decode()) == 0
-            or len(style_2_result.stdout.decode()) == 0
-        )
+        return ["<replacement " not in section for section in sections]
+
+    style_1_ok = formatted(STYLE_1)
+    style_2_ok = formatted(STYLE_2)
 
+    bad = [
+        str(source_file)
+        for source_file, ok_1, ok_2 in zip(C_FILES, style_1_ok, style_2_ok)
+        if not (ok_1 or ok_2)
+    ]
+    assert not bad, f"Not formatted: {bad}"
 
-def test_warnings(json_metadata):
-    json_metadata["type"] = "coding-standard"
-    json_metadata[
-        "description"
-    ] = "Check that code does not produce errors when compiled."
 
+@meta("coding-standard", "Check that code does not produce errors when compiled.")
+def test_warnings():
     # result = subprocess.run("make clean && make", capture_output=True, shell=True)
     # assert result.stderr.decode() == ""
 
     assert True
 
 
-def test_usage(client, json_metadata):
-    json_metadata["type"] = "core"
-    json_metadata["description"] = ""
-
+@meta("core", "")
+def test_usage(client):
     result = client()
-    assert result.stdout == b""
-    assert result.stderr != b""
-    assert result.returncode == 1
+    assert_usage_error(result)
 
-    stderr = result.stderr.decode()
-    message, usage = stderr.split("\n", 1)
-
-    # First line should be error message
-    assert not message.startswith("Usage")
-    # Second line should contain the usage
-    assert "Usage" in usage
-
-
-def test_help(client, json_metadata):
-    json_metadata["type"] = "core"
-    json_metadata[
-        "description"
-    ] = "Check that help message is printed to stdout and the correct return code is returned."
 
+@meta(
+    "core",
+    "Check that help message is printed to stdout and the correct return code is returned.",
+)
+def test_help(client):
     result = client("--help")
     assert result.stdout != b""
     assert result.stderr == b""
@@ -118,152 +301,88 @@ def test_help(client, json_metadata):
     assert stdout.strip().startswith("Usage")
 
 
-def test_unknown_option(client, json_metadata):
-    json_metadata["type"] = "core"
-    json_metadata[
-        "description"
-    ] = "Check that an unknown option is handled properly (nothing printed to stdout, something is printed to stderr, and correct return code is returned)."
-
+@meta(
+    "core",
+    "Check that an unknown option is handled properly "
+    "(nothing printed to stdout, something is printed to stderr, and correct return code is returned).",
+)
+def test_unknown_option(client):
     result = client("--unknown")
-    assert result.stdout == b""
-    assert result.stderr != b""
-    assert result.returncode == 1
+    assert_usage_error(result)
 
-    stderr = result.stderr.decode()
-    message, usage = stderr.split("\n", 1)
-
-    # First line should be error message
-    assert not message.startswith("Usage")
-    # Second line should contain the usage
-    assert "Usage" in usage
-
-
-def test_extra_arg(client, json_metadata):
-    json_metadata["type"] = "core"
-    json_metadata[
-        "description"
-    ] = "Check that an extra argument is handled properly (nothing printed to stdout, something is printed to stderr, and correct return code is returned)."
 
+@meta(
+    "core",
+    "Check that an extra argument is handled properly "
+    "(nothing printed to stdout, something is printed to stderr, and correct return code is returned).",
+)
+def test_extra_arg(client):
     result = client("reverse test extra")
-    assert result.stdout == b""
-    assert result.stderr != b""
-    assert result.returncode == 1
-
-    stderr = result.stderr.decode()
-    message, usage = stderr.split("\n", 1)
-
-    # First line should be error message
-    assert not message.startswith("Usage")
-    # Second line should contain the usage
-    assert "Usage" in usage
+    assert_usage_error(result)
 
 
-def test_less_args(client, json_metadata):
-    json_metadata["type"] = "core"
-    json_metadata[
-        "description"
-    ] = "Check that too few arguments are handled properly (nothing printed to stdout, something is printed to stderr, and correct return code is returned)."
-
+@meta(
+    "core",
+    "Check that too few arguments are handled properly "
+    "(nothing printed to stdout, something is printed to stderr, and correct return code is returned).",
+)
+def test_less_args(client):
     result = client("reverse")
-    assert result.stdout == b""
-    assert result.stderr != b""
-    assert result.returncode == 1
+    assert_usage_error(result)
 
-    stderr = result.stderr.decode()
-    message, usage = stderr.split("\n", 1)
-
-    # First line should be error message
-    assert not message.startswith("Usage")
-    # Second line should contain the usage
-    assert "Usage" in usage
-
-
-def test_bad_action(client, json_metadata):
-    json_metadata["type"] = "advance"
-    json_metadata[
-        "description"
-    ] = "Check that an unknown action is handled properly (nothing printed to stdout, something is printed to stderr, and correct return code is returned)."
 
+@meta(
+    "advance",
+    "Check that an unknown action is handled properly "
+    "(nothing printed to stdout, something is printed to stderr, and correct return code is returned).",
+)
+def test_bad_action(client):
     result = client("test test")
-    assert result.stdout == b""
-    assert result.stderr != b""
-    assert result.returncode == 1
+    assert_usage_error(result)
 
-    stderr = result.stderr.decode()
-    message, usage = stderr.split("\n", 1)
-
-    # First line should be error message
-    assert not message.startswith("Usage")
-    # Second line should contain the usage
-    assert "Usage" in usage
-
-
-def test_bad_port(client, json_metadata):
-    json_metadata["type"] = "advance"
-    json_metadata["description"] = (
-        "Check that an invalid port is handled properly (nothing printed to stdout, something is "
-        "printed to stderr, and correct return code is returned). Example: -p abcd"
-    )
 
+@meta(
+    "advance",
+    "Check that an invalid port is handled properly "
+    "(nothing printed to stdout, something is printed to stderr, and correct return code is returned). Example: -p abcd",
+)
+def test_bad_port(client):
     result = client("-p foobar reverse test")
-    assert result.stdout == b""
-    assert result.stderr != b""
-    assert result.returncode == 1
-
-    stderr = result.stderr.decode()
-    message, usage = stderr.split("\n", 1)
-
-    # First line should be error message
-    assert not message.startswith("Usage")
-    # Second line should contain the usage
-    assert "Usage" in usage
+    assert_usage_error(result)
 
 
-def test_bad_port_2(client, json_metadata):
-    json_metadata["type"] = "advance"
-    json_metadata["description"] = (
-        "Check that an invalid port is handled properly (nothing printed to stdout, something is "
-        "printed to stderr, and correct return code is returned). Example: -p 123abc"
-    )
-
+@meta(
+    "advance",
+    "Check that an invalid port is handled properly "
+    "(nothing printed to stdout, something is printed to stderr, and correct return code is returned). Example: -p 123abc",
+)
+def test_bad_port_2(client):
     result = client("-p 8080f reverse test")
-    assert result.stdout == b""
-    assert result.stderr != b""
-    assert result.returncode == 1
+    assert_usage_error(result)
 
-    stderr = result.stderr.decode()
-    message, usage = stderr.split("\n", 1)
-
-    # First line should be error message
-    assert not message.startswith("Usage")
-    # Second line should contain the usage
-    assert "Usage" in usage
-
-
-def test_no_connection(client, json_metadata):
-    json_metadata["type"] = "advance"
-    json_metadata["description"] = (
-        "Check that an error is returned when a server is not available ",
-        "(nothing printed to stdout, something is printed to stderr, and correct return code is returned).",
-    )
 
+@meta(
+    "advance",
+    "Check that an error is returned when a server is not available "
+    "(nothing printed to stdout, something is printed to stderr, and correct return code is returned).",
+)
+def test_no_connection(client):
     result = client("reverse test")
     assert result.stdout == b""
     assert result.stderr != b""
     assert result.returncode == 1
 
 
-def test_normal_input(client, server, json_metadata):
-    json_metadata["type"] = "core"
-    json_metadata["description"] = (
-        "Check normal function ",
-        "(correct resposne is printed to stdout, nothing is printed to stderr, and correct return code is returned). ",
-        "Also use the verbose flag to have something printed to stderr.",
-    )
-
+@meta(
+    "core",
+    "Check normal function "
+    "(correct resposne is printed to stdout, nothing is printed to stderr, and correct return code is returned). "
+    "Also use the verbose flag to have something printed to stderr.",
+)
+def test_normal_input(client, server):
     server_process = server()
 
-    result = client("reverse test")
+    result = client(f"--port {PORT} reverse test")
     assert result.stdout != b""
     assert result.stderr == b""
     assert result.returncode == 0
@@ -272,7 +391,7 @@ def test_normal_input(client, server, json_metadata):
     assert stdout == "tset"
 
     # This time there should be something coming out of stderr
-    result = client("--verbose reverse test")
+    result = client(f"--port {PORT} --verbose reverse test")
     assert result.stdout != b""
     # I didn't force students to use logging, so I can't check if they print
     # anything to stderr.
@@ -283,16 +402,15 @@ def test_normal_input(client, server, json_metadata):
     assert stdout == "tset"
 
 
-def test_server_connection(client, server, json_metadata):
-    json_metadata["type"] = "core"
-    json_metadata["description"] = (
-        "Check that the client is using the server ",
-        "(incorrect response printed to stdout, nothing is printed to stderr, and correct return code is returned).",
-    )
-
+@meta(
+    "core",
+    "Check that the client is using the server "
+    "(incorrect response printed to stdout, nothing is printed to stderr, and correct return code is returned).",
+)
+def test_server_connection(client, server):
     server_process = server(same_output=True)
 
-    result = client("reverse test")
+    result = client(f"--port {SAME_OUTPUT_PORT} reverse test")
     assert result.stdout != b""
     assert result.stderr == b""
     assert result.returncode == 0
@@ -301,13 +419,11 @@ def test_server_connection(client, server, json_metadata):
     assert stdout == "test"
 
 
-def test_different_port(client, server, json_metadata):
-    json_metadata["type"] = "core"
-    json_metadata["description"] = ("Check that changing the port works.",)
-
-    server_process = server(port=8081)
+@meta("core", "Check that changing the port works.")
+def test_different_port(client, server):
+    server_process = server(port=OTHER_PORT)
 
-    result = client('--port 8081 reverse "hello world"')
+    result = client(["--port", f"{OTHER_PORT}", "reverse", "hello world"])
     assert result.stdout != b""
     assert result.stderr == b""
     assert result.returncode == 0
@@ -316,39 +432,36 @@ def test_different_port(client, server, json_metadata):
     assert stdout == "dlrow olleh"
 
 
-def test_large_input(client, server, json_metadata):
-    json_metadata["type"] = "core"
-    json_metadata["description"] = "Unable to handle 1024 byte input."
-    json_metadata["description"] = "Check with 1024 byte input"
-
+@meta("core", "Check with 1024 byte input")
+def test_large_input(client, server):
     server_process = server()
-    text_input = "x" * 1024  # Make we don't go above the limit for the lab
 
-    result = client(f'uppercase "{text_input}"')
+    result = client(["--port", f"{PORT}", "uppercase", LARGE_INPUT])
     assert result.stdout != b""
     assert result.stderr == b""
     assert result.returncode == 0
 
     stdout = result.stdout.decode().strip()
-    assert stdout == text_input.upper()
+    assert stdout == LARGE_INPUT_EXPECTED
 
     print(result.stderr.decode())
 
 
-def test_actions(client, server, json_metadata):
-    json_metadata["type"] = "core"
-    json_metadata["description"] = "Test that program works with all actions."
-
+@meta("core", "Test that program works with all actions.")
+@pytest.mark.parametrize(
+    "action, expected",
+    [
+        pytest.param(action, tcp_server.actions[action](ACTIONS_TEXT), id=action)
+        for action in ["lowercase", "uppercase", "title-case", "reverse"]
+    ],
+)
+def test_actions(client, server, action, expected):
     server_process = server()
-    text = "this is a test"
-
-    actions = ["lowercase", "uppercase", "title-case", "reverse"]
 
-    for action in actions:
-        result = client(f'{action} "{text}"')
-        assert result.stdout != b""
-        assert result.stderr == b""
-        assert result.returncode == 0
+    result = client(["--port", f"{PORT}", action, ACTIONS_TEXT])
+    assert result.stdout != b""
+    assert result.stderr == b""
+    assert result.returncode == 0
 
-        stdout = result.stdout.decode().strip()
-        assert stdout == tcp_server.actions[action](text)
+    stdout = result.stdout.decode().strip()
+    assert stdout == expected